@@ -1,14 +1,16 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+from itertools import accumulate
 from statistics import mode
 import warnings
 
-import numpy as np
-
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.checkpoint as cp
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from mmcv.cnn import (UPSAMPLE_LAYERS, ConvModule, build_activation_layer,
-                      build_norm_layer, DepthwiseSeparableConvModule)
+                      build_conv_layer, build_norm_layer,
+                      DepthwiseSeparableConvModule)
 from mmcv.runner import BaseModule
 from mmcv.utils.parrots_wrapper import _BatchNorm
 
@@ -18,6 +20,53 @@ from ..builder import BACKBONES
 from ..utils import UpConvBlock
 
 
+def _to_torch_conv(conv):
+    """Copy a conv built by mmcv into a plain ``nn.Conv2d``, which FX
+    quantization can trace and match against its fusion patterns."""
+    torch_conv = nn.Conv2d(
+        conv.in_channels,
+        conv.out_channels,
+        conv.kernel_size,
+        stride=conv.stride,
+        padding=conv.padding,
+        dilation=conv.dilation,
+        groups=conv.groups,
+        bias=conv.bias is not None,
+        padding_mode=conv.padding_mode)
+    torch_conv.load_state_dict(conv.state_dict())
+    return torch_conv
+
+
+def _cat_into(tensors, buf):
+    """Concatenate ``tensors`` along channels by copying each of them into
+    its channel slice of the preallocated ``buf``."""
+    start = 0
+    for t in tensors:
+        end = start + t.shape[1]
+        buf[:, start:end].copy_(t)
+        start = end
+    return buf
+
+
+# torch.compile'd functions, keyed by (function, mode), see _compiled.
+_compiled_fns = {}
+
+
+def _compiled(fn, mode):
+    """Return ``fn`` compiled with ``torch.compile`` in ``mode``.
+
+    ``fn`` is a plain function taking the module as its first argument, not
+    a bound method. The compiled callable is cached per function and mode
+    and holds no module, so it is never stored on an instance: deepcopies
+    and pickles of the model keep running their own weights, and dynamo
+    guards on the module passed in.
+    """
+    key = (fn, mode)
+    if key not in _compiled_fns:
+        _compiled_fns[key] = torch.compile(fn, mode=mode, dynamic=False)
+    return _compiled_fns[key]
+
+
 class BasicConvBlock(nn.Module):
     """Basic convolutional block for UNet.
 
@@ -37,6 +86,9 @@ class BasicConvBlock(nn.Module):
             Default: 1.
         with_cp (bool): Use checkpoint or not. Using checkpoint will save some
             memory while slowing down the training speed. Default: False.
+        separable (bool): Use depthwise separable convolution for all but
+            the first convolutional layer, which stays dense as it changes
+            the number of channels. Default: False.
         conv_cfg (dict | None): Config dict for convolution layer.
             Default: None.
         norm_cfg (dict | None): Config dict for normalization layer.
@@ -55,6 +107,7 @@ class BasicConvBlock(nn.Module):
                  stride=1,
                  dilation=1,
                  with_cp=False,
+                 separable=False,
                  conv_cfg=None,
                  norm_cfg=dict(type='BN'),
                  act_cfg=dict(type='ReLU'),
@@ -67,8 +120,10 @@ class BasicConvBlock(nn.Module):
         self.with_cp = with_cp
         convs = []
         for i in range(num_convs):
+            conv_module = DepthwiseSeparableConvModule \
+                if separable and i > 0 else ConvModule
             convs.append(
-                ConvModule(
+                conv_module(
                     in_channels=in_channels if i == 0 else out_channels,
                     out_channels=out_channels,
                     kernel_size=3,
@@ -91,6 +146,141 @@ class BasicConvBlock(nn.Module):
         return out
 
 
+class SplitFuseConv(nn.Module):
+    """1x1 conv over several feature maps without concatenating them.
+
+    ``conv1x1(cat([a, b, c]))`` equals ``conv_a(a) + conv_b(b) + conv_c(c)``
+    where each conv holds the matching input-channel slice of the full
+    weight. Each input gets its own 1x1 conv, the results are summed and
+    then normalized and activated, so the concatenated tensor is never
+    materialized.
+
+    Args:
+        in_channels (Sequence[int]): Number of channels of each input.
+        out_channels (int): Number of output channels.
+        conv_cfg (dict | None): Config dict for convolution layer.
+            Default: None.
+        norm_cfg (dict | None): Config dict for normalization layer.
+            Default: dict(type='BN').
+        act_cfg (dict | None): Config dict for activation layer.
+            Default: dict(type='ReLU').
+    """
+
+    def __init__(self,
+                 in_channels,
+                 out_channels,
+                 conv_cfg=None,
+                 norm_cfg=dict(type='BN'),
+                 act_cfg=dict(type='ReLU')):
+        super(SplitFuseConv, self).__init__()
+        with_norm = norm_cfg is not None
+        self.convs = nn.ModuleList()
+        for i, channels in enumerate(in_channels):
+            # A single bias is enough for the sum, and none with a norm.
+            self.convs.append(
+                build_conv_layer(
+                    conv_cfg,
+                    channels,
+                    out_channels,
+                    kernel_size=1,
+                    bias=(i == 0 and not with_norm)))
+        self.norm = build_norm_layer(norm_cfg, out_channels)[1] \
+            if with_norm else None
+        self.activate = build_activation_layer(act_cfg) \
+            if act_cfg is not None else None
+
+    def forward(self, inputs):
+        """Forward function."""
+
+        out = self.convs[0](inputs[0])
+        for conv, x in zip(self.convs[1:], inputs[1:]):
+            out = out + conv(x)
+        if self.norm is not None:
+            out = self.norm(out)
+        if self.activate is not None:
+            out = self.activate(out)
+        return out
+
+
+class EncoderFuseStage(nn.Module):
+    """Encoder Feature Fuse Block (EFFU) feeding one encoder stage.
+
+    The pooled features of all previous encoder stages are fused by
+    CBAM + Conv1*1 on their concatenation, or by Conv1*1 + CBAM when the
+    1x1 conv is a SplitFuseConv, and then passed through (Conv3*3)*2.
+
+    Args:
+        cbam (nn.Module): Channel and spatial attention block.
+        c1 (nn.Module): 1x1 fuse conv, taking the concatenated input or,
+            for a SplitFuseConv, the list of inputs.
+        c2 (nn.Module): Convolution block of the encoder stage.
+        with_cp (bool): Use checkpoint for the whole block or not.
+            Default: False.
+        memory_format (torch.memory_format): Layout kept between the
+            layers. Default: torch.contiguous_format.
+        compile_cbam (bool): Run the CBAM forward through ``torch.compile``
+            (mode 'reduce-overhead'). Default: False.
+    """
+
+    def __init__(self,
+                 cbam,
+                 c1,
+                 c2,
+                 with_cp=False,
+                 memory_format=torch.contiguous_format,
+                 compile_cbam=False):
+        super(EncoderFuseStage, self).__init__()
+        self.cbam = cbam
+        self.c1 = c1
+        self.c2 = c2
+        self.with_cp = with_cp
+        self.memory_format = memory_format
+        self.compile_cbam = compile_cbam
+
+    @property
+    def split_fuse(self):
+        return isinstance(self.c1, SplitFuseConv)
+
+    def _attention(self, x):
+        if self.compile_cbam:
+            # The compiled function gets the CBAM as an argument, see
+            # _compiled for why it is not stored on the module.
+            out = _compiled(type(self.cbam).forward,
+                            'reduce-overhead')(self.cbam, x)
+        else:
+            out = self.cbam(x)
+        # CBAMBlock's broadcast multiplies do not guarantee the input layout
+        # is kept, so re-lay it out before the next conv.
+        return out.contiguous(memory_format=self.memory_format)
+
+    def forward(self, inputs, cat_buf=None):
+        """Forward function.
+
+        Args:
+            inputs (list[Tensor]): Pooled features of the previous stages.
+            cat_buf (Tensor, optional): Preallocated buffer to concatenate
+                the inputs into. Default: None.
+        """
+
+        def _inner_forward(*inputs):
+            if self.split_fuse:
+                out = self._attention(self.c1(inputs))
+            else:
+                if len(inputs) == 1:
+                    out = inputs[0]
+                elif cat_buf is not None:
+                    out = _cat_into(inputs, cat_buf)
+                else:
+                    out = torch.cat(inputs, dim=1)
+                out = self.c1(self._attention(out))
+            return self.c2(out)
+
+        if self.with_cp and any(x.requires_grad for x in inputs):
+            return cp.checkpoint(
+                _inner_forward, *inputs, use_reentrant=False)
+        return _inner_forward(*inputs)
+
+
 @BACKBONES.register_module()
 class AMDNet_EFFU(BaseModule):
     """AMDNet_EFFU backbone.
@@ -126,6 +316,30 @@ class AMDNet_EFFU(BaseModule):
             Default: (1, 1, 1, 1).
         with_cp (bool): Use checkpoint or not. Using checkpoint will save some
             memory while slowing down the training speed. Default: False.
+        effu_with_cp (Sequence[bool]): Whether to checkpoint the whole EFFU
+            (CBAM + Conv1*1 + (Conv3*3)*2) of encoder stages [1, num_stages)
+            as a single block. Enabling only the deepest stages, where the
+            concatenated input is largest, gives most of the memory saving
+            for little recompute. len(effu_with_cp) is equal to
+            (num_stages-1). Default: (False, False, False, False).
+        pool_type (str): Pooling used to build the multi-scale EFFU inputs,
+            'max' or 'avg'. Average pooling maps to cheaper kernels in
+            channels_last. With ``effu_split_fuse`` it is also directly
+            followed by the linear 1x1 convs, so the two can be folded at
+            inference; in the default EFFU, CBAM sits in between.
+            Default: 'max'.
+        separable_from_stage (int | None): Use depthwise separable 3x3 convs
+            (except the first conv of each block) in the encoder and decoder
+            blocks of this stage and all deeper ones, where the channel
+            count makes the dense 3x3 convs dominate the FLOPs. None keeps
+            every conv dense. Default: None.
+        effu_split_fuse (bool): Replace the concat + Conv1*1 of each EFFU by
+            a SplitFuseConv, which sums one 1x1 conv per pooled input and
+            skips the concatenated buffer. CBAM then runs on the fused
+            output instead of on the concatenation, i.e. the EFFU becomes
+            Conv1*1 + CBAM + (Conv3*3)*2. As the CBAM moves, this is a
+            different network: it has to be trained from scratch and can
+            not load checkpoints of the default EFFU. Default: False.
         conv_cfg (dict | None): Config dict for convolution layer.
             Default: None.
         norm_cfg (dict | None): Config dict for normalization layer.
@@ -140,6 +354,44 @@ class AMDNet_EFFU(BaseModule):
         dcn (bool): Use deformable convolution in convolutional layer or not.
             Default: None.
         plugins (dict): plugins for convolutional layers. Default: None.
+        dec_upsample (str): How the decoder upsamples the deeper feature map
+            before concatenating it with the skip connection. 'bilinear' uses
+            a parameter-free bilinear interpolation, 'nearest' a pure gather
+            that leaves the smoothing to the following decoder convs, and
+            'deconv' a learned 2x2 stride-2 transposed conv, which saves the
+            separate interpolation pass. Default: 'bilinear'.
+        channels_last (bool): Convert the weights to ``torch.channels_last``
+            at construction and run the forward pass in NHWC layout. Works
+            best together with ``torch.backends.cudnn.benchmark = True`` and
+            fp16/bf16 on GPUs with TensorCores. The returned features are
+            NHWC too, so the decode head must not rely on ``.view`` of
+            contiguous NCHW tensors. Default: False.
+        amp_dtype (torch.dtype | None): Run the forward pass under
+            ``torch.autocast`` with this dtype (``torch.bfloat16`` or
+            ``torch.float16``). Weights and BN running stats stay in
+            float32, and the outputs are cast back to the input dtype so the
+            decode head needs no change. Combined with ``channels_last`` this
+            is the intended setting for Ampere and newer GPUs. None runs in
+            the input dtype. Default: None.
+        fixed_input_shape (tuple[int] | None): Input (H, W) served at
+            inference. When an input of this size runs with gradients
+            disabled, every channel concatenation writes into a buffer kept
+            from the previous call instead of allocating a new tensor. The
+            buffers are (re)allocated on first use or when the batch size,
+            dtype or device changes. Default: None.
+        use_compile (bool): Run the network body through ``torch.compile``,
+            so that Inductor can fuse the pooling, concat and
+            norm/activation tails. Shapes are treated as static. The input
+            size check and the CUDA graph dispatch of ``capture`` stay
+            eager. Requires PyTorch >= 2.0. Default: False.
+        compile_mode (str): ``mode`` passed to ``torch.compile``.
+            Default: 'max-autotune'.
+        compile_cbam (bool): Compile only the forward of each EFFU CBAMBlock
+            (mode 'reduce-overhead'), so that its pooling, MLP, sigmoid and
+            broadcast multiplies are fused into few kernels while the rest
+            of the network stays eager. Has no effect when ``use_compile``
+            is set, as the whole forward is compiled then. Requires
+            PyTorch >= 2.0. Default: False.
         pretrained (str, optional): model pretrained path. Default: None
         init_cfg (dict or list[dict], optional): Initialization config dict.
             Default: None
@@ -161,6 +413,10 @@ class AMDNet_EFFU(BaseModule):
                  enc_dilations=(1, 1, 1, 1, 1),
                  dec_dilations=(1, 1, 1, 1),
                  with_cp=False,
+                 effu_with_cp=(False, False, False, False),
+                 pool_type='max',
+                 separable_from_stage=None,
+                 effu_split_fuse=False,
                  conv_cfg=None,
                  norm_cfg=dict(type='BN'),
                  act_cfg=dict(type='ReLU'),
@@ -168,6 +424,13 @@ class AMDNet_EFFU(BaseModule):
                  norm_eval=False,
                  dcn=None,
                  plugins=None,
+                 dec_upsample='bilinear',
+                 channels_last=False,
+                 amp_dtype=None,
+                 fixed_input_shape=None,
+                 use_compile=False,
+                 compile_mode='max-autotune',
+                 compile_cbam=False,
                  pretrained=None,
                  init_cfg=None):
         super(AMDNet_EFFU, self).__init__(init_cfg)
@@ -223,41 +486,84 @@ class AMDNet_EFFU(BaseModule):
             f'while the dec_dilations is {dec_dilations}, the length of '\
             f'dec_dilations is {len(dec_dilations)}, and the num_stages is '\
             f'{num_stages}.'
+        assert len(effu_with_cp) == (num_stages-1), \
+            'The length of effu_with_cp should be equal to (num_stages-1), '\
+            f'while the effu_with_cp is {effu_with_cp}, the length of '\
+            f'effu_with_cp is {len(effu_with_cp)}, and the num_stages is '\
+            f'{num_stages}.'
+        assert pool_type in ('max', 'avg'), \
+            f'pool_type should be "max" or "avg", while the pool_type is '\
+            f'{pool_type}.'
+        assert dec_upsample in ('bilinear', 'nearest', 'deconv'), \
+            f'dec_upsample should be "bilinear", "nearest" or "deconv", '\
+            f'while the dec_upsample is {dec_upsample}.'
         self.num_stages = num_stages
+        self.dec_upsample = dec_upsample
         self.strides = strides
         self.downsamples = downsamples
+        self.effu_split_fuse = effu_split_fuse
         self.norm_eval = norm_eval
         self.base_channels = base_channels
+        # The whole downsample rate only depends on the config, so it is
+        # computed once here instead of on every forward.
+        self._wdr = 1
+        for i in range(1, num_stages):
+            if strides[i] == 2 or downsamples[i - 1]:
+                self._wdr *= 2
+        self.memory_format = torch.channels_last if channels_last \
+            else torch.contiguous_format
+        self.amp_dtype = amp_dtype
+        self.compile_mode = compile_mode if use_compile else None
+        self.compile_cbam = compile_cbam and not use_compile
+        self.fixed_input_shape = tuple(fixed_input_shape) \
+            if fixed_input_shape is not None else None
+        # Concat outputs reused across calls, see AMDNet_EFFU._cat.
+        self._cat_bufs = {}
+        # (graph, static input, static outputs, kept buffers) set by capture.
+        self._cuda_graph = None
+        # (module, {name: layer}) pairs replaced by AMDNet_EFFU.fuse.
+        self._fused_modules = []
 
         # self.encoder = nn.ModuleList()
         # self.decoder = nn.ModuleList()
 
-        self.pool_16= nn.MaxPool2d(16, 16, ceil_mode=True)
-        self.pool_8 = nn.MaxPool2d(8, 8, ceil_mode=True)
-        self.pool_4 = nn.MaxPool2d(4, 4, ceil_mode=True)
-        self.pool_2 = nn.MaxPool2d(2, 2, ceil_mode=True)
-        self.up_2   = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-        self.up_4   = nn.Upsample(scale_factor=4, mode='bilinear', align_corners=True)
-        self.up_8   = nn.Upsample(scale_factor=8, mode='bilinear', align_corners=True)
-        self.up_16  = nn.Upsample(scale_factor=16, mode='bilinear', align_corners=True)
+        # Coarser scales are obtained by chaining pool_2 in forward, which is
+        # equivalent to a single 2^k pool on inputs divisible by 2^k.
+        if pool_type == 'avg':
+            self.pool_2 = nn.AvgPool2d(2, 2, ceil_mode=True)
+        else:
+            self.pool_2 = nn.MaxPool2d(2, 2, ceil_mode=True)
 
         enc_channels = []
         for i in range(num_stages):
             inp_channels = base_channels * 2**i
             enc_channels.append(inp_channels)
-        enc_channels = np.array(enc_channels)
+        # cum_channels[i - 1] is the channel count of the first i stages.
+        cum_channels = list(accumulate(enc_channels))
 
-        # Encoder Feature Fuse Block (EFFU): CBAM + Conv1*1 + (Conv3*3)*2
-        self.effu_cbam = nn.ModuleList()
+        # Encoder Feature Fuse Block (EFFU): CBAM + Conv1*1 + (Conv3*3)*2,
+        # or Conv1*1 + CBAM + (Conv3*3)*2 with effu_split_fuse.
+        effu_cbam = []
         for i in range(1, num_stages):
-            self.effu_cbam.append(CBAMBlock(np.sum(enc_channels[:i])))
+            effu_cbam.append(
+                CBAMBlock(enc_channels[i-1] if effu_split_fuse
+                          else cum_channels[i-1]))
 
-        self.effu_c1 = nn.ModuleList()
+        effu_c1 = []
         for i in range(1, num_stages):
+            if effu_split_fuse:
+                effu_c1.append(
+                    SplitFuseConv(
+                        in_channels=enc_channels[:i],
+                        out_channels=enc_channels[i-1],
+                        conv_cfg=conv_cfg,
+                        norm_cfg=norm_cfg,
+                        act_cfg=act_cfg))
+                continue
             effu_c1_block = []
             effu_c1_block.append(
                 ConvModule(
-                    in_channels=np.sum(enc_channels[:i]),
+                    in_channels=cum_channels[i-1],
                     out_channels=enc_channels[i-1],
                     kernel_size=1,
                     stride=1,
@@ -265,10 +571,10 @@ class AMDNet_EFFU(BaseModule):
                     conv_cfg=conv_cfg,
                     norm_cfg=norm_cfg,
                     act_cfg=act_cfg))
-            self.effu_c1.append((nn.Sequential(*effu_c1_block)))
+            effu_c1.append((nn.Sequential(*effu_c1_block)))
 
         # effu (conv3*3)*2
-        self.effu_c2 = nn.ModuleList()
+        effu_c2 = []
         for i in range(num_stages):
             enc_conv_block = []
             enc_conv_block.append(
@@ -279,14 +585,30 @@ class AMDNet_EFFU(BaseModule):
                     stride=strides[i],
                     dilation=enc_dilations[i],
                     with_cp=with_cp,
+                    separable=separable_from_stage is not None
+                    and i >= separable_from_stage,
                     conv_cfg=conv_cfg,
                     norm_cfg=norm_cfg,
                     act_cfg=act_cfg,
                     dcn=None,
                     plugins=None))
-            self.effu_c2.append((nn.Sequential(*enc_conv_block)))
+            effu_c2.append((nn.Sequential(*enc_conv_block)))
             in_channels = base_channels * 2**i
 
+        # enc_stem runs on the input image, enc_stages[i-1] fuses the pooled
+        # x_0 .. x_{i-1} into x_i.
+        self.enc_stem = effu_c2[0]
+        self.enc_stages = nn.ModuleList()
+        for i in range(1, num_stages):
+            self.enc_stages.append(
+                EncoderFuseStage(
+                    cbam=effu_cbam[i-1],
+                    c1=effu_c1[i-1],
+                    c2=effu_c2[i],
+                    with_cp=effu_with_cp[i-1],
+                    memory_format=self.memory_format,
+                    compile_cbam=self.compile_cbam))
+
         self.decoder = nn.ModuleList()
         for i in range(num_stages-1):
             self.decoder.append(
@@ -297,92 +619,144 @@ class AMDNet_EFFU(BaseModule):
                     stride=1,
                     dilation=1,
                     with_cp=with_cp,
+                    separable=separable_from_stage is not None
+                    and i >= separable_from_stage,
                     conv_cfg=conv_cfg,
                     norm_cfg=norm_cfg,
                     act_cfg=act_cfg,
                     dcn=None,
                     plugins=None))
 
+        # dec_up[i] upsamples the input of decoder[i] coming from stage i+1.
+        self.dec_up = None
+        if dec_upsample == 'deconv':
+            self.dec_up = nn.ModuleList()
+            for i in range(num_stages-1):
+                self.dec_up.append(
+                    nn.ConvTranspose2d(
+                        enc_channels[i+1],
+                        enc_channels[i+1],
+                        kernel_size=2,
+                        stride=2))
+
+        # Convert all conv weights once so that every conv / pool / upsample
+        # in forward runs in the same layout without per-call permutes.
+        self.to(memory_format=self.memory_format)
 
     def forward(self, x):
         self._check_input_divisible(x)
-        x0 = self.effu_c2[0](x)
-
-        # print("x0 shape: ", x0.shape)
-
-        x1 = self.effu_c2[1](
-            self.effu_c1[0](
-                self.effu_cbam[0](
-                    self.pool_2(x0)
-                )
-            )
-        )
-
-        x2 = self.effu_c2[2](
-            self.effu_c1[1](
-                self.effu_cbam[1](
-                    torch.cat([
-                        self.pool_4(x0),
-                        self.pool_2(x1)
-                    ], dim=1)
-                )
-            )
-        )
-
-        x3 = self.effu_c2[3](
-            self.effu_c1[2](
-                self.effu_cbam[2](
-                    torch.cat([
-                        self.pool_8(x0),
-                        self.pool_4(x1),
-                        self.pool_2(x2)
-                    ], dim=1)
-                )
-            )
-        )
-
-        x4 = self.effu_c2[4](
-            self.effu_c1[3](
-                self.effu_cbam[3](
-                    torch.cat([
-                        self.pool_16(x0),
-                        self.pool_8(x1),
-                        self.pool_4(x2),
-                        self.pool_2(x3)
-                    ], dim=1)
+        if self._cuda_graph is not None and not self.training \
+                and not torch.is_grad_enabled():
+            graph, static_input, static_outputs, _ = self._cuda_graph
+            if x.shape == static_input.shape \
+                    and x.dtype == static_input.dtype \
+                    and x.device == static_input.device:
+                static_input.copy_(x)
+                graph.replay()
+                return static_outputs
+        if self.compile_mode is not None:
+            return _compiled(type(self)._eager_forward,
+                             self.compile_mode)(self, x)
+        return self._eager_forward(x)
+
+    def _eager_forward(self, x):
+        if self.amp_dtype is None:
+            return self._forward(x)
+        # The input size check in forward stays outside of autocast.
+        with torch.autocast(device_type=x.device.type, dtype=self.amp_dtype):
+            dec_outs = self._forward(x)
+        return [out.to(x.dtype) for out in dec_outs]
+
+    def capture(self, example_input):
+        """Capture the inference forward pass in a CUDA graph.
+
+        Later calls in eval mode with gradients disabled and an input of the
+        same shape, dtype and device copy the input into a static buffer and
+        replay the graph, which removes the per-kernel launch overhead at
+        small batch sizes. Other inputs run the eager path. The replayed
+        outputs are static tensors overwritten by the next replay, so clone
+        them if they must outlive it. The eager path is captured even with
+        ``use_compile``, but not with ``compile_cbam``, whose
+        'reduce-overhead' CBAMs record CUDA graphs of their own.
+
+        The graph replays the raw pointers of the layers it recorded, so any
+        change to the model's structure invalidates it. ``fuse``,
+        ``train(True)`` and the restoring of fused layers drop the capture;
+        call ``capture`` again afterwards.
+
+        Args:
+            example_input (Tensor): A CUDA input with the served shape.
+
+        Returns:
+            AMDNet_EFFU: The model itself.
+        """
+        assert example_input.is_cuda, 'CUDA graphs need a CUDA input.'
+        assert not self.compile_cbam, \
+            'capture can not nest the CUDA graphs of compile_cbam.'
+        self._check_input_divisible(example_input)
+        self.eval()
+        self._cuda_graph = None
+        static_input = example_input.clone()
+        with torch.no_grad():
+            # Warm up on a side stream so that cudnn autotuning and lazy
+            # allocations happen before the capture.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._eager_forward(static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_outputs = self._eager_forward(static_input)
+        # The graph reads and writes the concat buffers in place, so keep
+        # them alive even if a later eager call reallocates _cat_bufs.
+        self._cuda_graph = (graph, static_input, static_outputs,
+                            dict(self._cat_bufs))
+        return self
+
+    def _forward(self, x):
+        # torch.cat keeps the layout as long as all its inputs share it, so a
+        # single conversion here is enough for the whole network.
+        x = x.contiguous(memory_format=self.memory_format)
+        static = self.fixed_input_shape is not None \
+            and tuple(x.shape[-2:]) == self.fixed_input_shape \
+            and not torch.is_grad_enabled()
+        enc_outs = [self.enc_stem(x)]
+
+        # pyramids[j] maps a downsample rate to the pooled x_j. Each scale
+        # is pooled once from the previous one and popped by the only stage
+        # that consumes it, so it is freed right after that stage.
+        pyramids = []
+        for i in range(1, self.num_stages):
+            pyramid = {1: enc_outs[-1]}
+            for k in range(1, self.num_stages - i + 1):
+                pyramid[2**k] = self.pool_2(pyramid[2**(k-1)])
+            pyramids.append(pyramid)
+            inputs = [py.pop(2**(i-j)) for j, py in enumerate(pyramids)]
+            cat_buf = None
+            if static and len(inputs) > 1 and not self.effu_split_fuse:
+                cat_buf = self._cat_buf(f'effu{i-1}', inputs)
+            enc_outs.append(self.enc_stages[i - 1](inputs, cat_buf))
+            del inputs
+        del pyramids
+
+        # Decode from the deepest feature up. Each skip connection is popped
+        # and dropped as soon as its decoder stage is done so the allocator
+        # can reuse it; the deepest feature is returned and stays alive.
+        dec_outs = [enc_outs.pop()]
+        for i in reversed(range(self.num_stages - 1)):
+            skip = enc_outs.pop()
+            dec_outs.append(
+                self.decoder[i](
+                    self._cat([
+                        skip,
+                        self._dec_upsample(dec_outs[-1], i)
+                    ], f'dec{i}', static)
                 )
             )
-        )
-
-        dec3 = self.decoder[3](
-            torch.cat([
-                x3,
-                self.up_2(x4)
-            ], dim=1)
-        )
-
-        dec2 = self.decoder[2](
-            torch.cat([
-                x2,
-                self.up_2(dec3)
-            ], dim=1)
-        )
-
-        dec1 = self.decoder[1](
-            torch.cat([
-                x1,
-                self.up_2(dec2)
-            ], dim=1)
-        )
-
-        dec0 = self.decoder[0](
-            torch.cat([
-                x0,
-                self.up_2(dec1)
-            ], dim=1)
-        )
-
-        dec_outs = [x4, dec3, dec2, dec1, dec0]
+            del skip
 
         return dec_outs
 
@@ -390,6 +764,15 @@ class AMDNet_EFFU(BaseModule):
     def train(self, mode=True):
         """Convert the model into training mode while keep normalization layer
         freezed."""
+        if mode:
+            # Training may swap layers (see _unfuse), which a CUDA graph
+            # recorded by capture can not follow.
+            self._cuda_graph = None
+            # The concat buffers only serve inference; do not keep them
+            # allocated through training epochs.
+            self._cat_bufs = {}
+        if mode and self._fused_modules:
+            self._unfuse()
         super(AMDNet_EFFU, self).train(mode)
         if mode and self.norm_eval:
             for m in self.modules():
@@ -397,15 +780,203 @@ class AMDNet_EFFU(BaseModule):
                 if isinstance(m, _BatchNorm):
                     m.eval()
 
+    def _cat(self, tensors, name, static=False):
+        """Concatenate along channels, into the reused buffer ``name`` for
+        fixed-shape inference."""
+        if not static:
+            return torch.cat(tensors, dim=1)
+        return _cat_into(tensors, self._cat_buf(name, tensors))
+
+    def _cat_buf(self, name, tensors):
+        """Return the buffer ``name`` sized for concatenating ``tensors``,
+        (re)allocating it in the module's memory format if needed."""
+        n, _, h, w = tensors[0].shape
+        shape = (n, sum(t.shape[1] for t in tensors), h, w)
+        buf = self._cat_bufs.get(name)
+        # Buffers allocated under inference_mode are inference tensors,
+        # which can not be updated in place outside of it.
+        if buf is None or buf.shape != shape \
+                or buf.dtype != tensors[0].dtype \
+                or buf.device != tensors[0].device \
+                or buf.is_inference() != torch.is_inference_mode_enabled():
+            buf = torch.empty(
+                shape,
+                dtype=tensors[0].dtype,
+                device=tensors[0].device,
+                memory_format=self.memory_format)
+            self._cat_bufs[name] = buf
+        return buf
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the EFFU layers were grouped into
+        # EncoderFuseStage modules keep them in effu_cbam, effu_c1 and
+        # effu_c2.
+        for key in list(state_dict):
+            if not key.startswith(prefix + 'effu_'):
+                continue
+            name, idx, rest = key[len(prefix):].split('.', 2)
+            idx = int(idx)
+            if name == 'effu_c2':
+                new_name = 'enc_stem' if idx == 0 \
+                    else f'enc_stages.{idx - 1}.c2'
+            else:
+                new_name = f'enc_stages.{idx}.{name[len("effu_"):]}'
+            state_dict[f'{prefix}{new_name}.{rest}'] = state_dict.pop(key)
+        super(AMDNet_EFFU, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+    def _dec_upsample(self, x, i):
+        """Upsample the deeper feature map fed to ``decoder[i]`` by 2x."""
+        if self.dec_up is not None:
+            return self.dec_up[i](x)
+        if self.dec_upsample == 'nearest':
+            return F.interpolate(x, scale_factor=2, mode='nearest')
+        # With channels_last the input is already NHWC here, which selects the
+        # faster bilinear kernel; the functional call also lets a compiler
+        # fuse the interpolation with the following concat.
+        return F.interpolate(
+            x, scale_factor=2, mode='bilinear', align_corners=True)
+
+    def fuse(self):
+        """Fold BN into the preceding conv of every ConvModule in the encoder,
+        the EFFU 1x1 convs and the decoder for inference.
+
+        For a SplitFuseConv every per-input conv is scaled by the BN and the
+        BN shift goes into the bias of the first one. The model is switched
+        to eval mode. The original conv and norm layers are kept aside and
+        put back by ``train(True)``.
+        """
+        self.eval()
+        if self._fused_modules:
+            return self
+        self._cuda_graph = None
+        layers_to_fuse = [self.enc_stem, self.decoder]
+        for stage in self.enc_stages:
+            layers_to_fuse += [stage.c1, stage.c2]
+        for layers in layers_to_fuse:
+            for m in layers.modules():
+                if isinstance(m, SplitFuseConv) \
+                        and isinstance(m.norm, _BatchNorm):
+                    self._fused_modules.append(
+                        (m, dict(convs=m.convs, norm=m.norm)))
+                    convs = nn.ModuleList()
+                    for k, conv in enumerate(m.convs):
+                        fused = fuse_conv_bn_eval(conv, m.norm)
+                        if k > 0:
+                            # The BN shift is added once, by convs[0].
+                            fused.bias = None
+                        convs.append(
+                            fused.to(memory_format=self.memory_format))
+                    m.convs = convs
+                    m.norm = None
+                    continue
+                if not (isinstance(m, ConvModule) and m.with_norm
+                        and isinstance(m.norm, _BatchNorm)):
+                    continue
+                self._fused_modules.append(
+                    (m, {'conv': m.conv, m.norm_name: m.norm}))
+                m.conv = fuse_conv_bn_eval(m.conv, m.norm).to(
+                    memory_format=self.memory_format)
+                setattr(m, m.norm_name, nn.Identity())
+        return self
+
+    def _unfuse(self):
+        """Restore the conv and norm layers replaced by ``fuse``."""
+        self._cuda_graph = None
+        for m, layers in self._fused_modules:
+            # Follow the fused convs if the model was moved or cast in the
+            # meantime.
+            p = next(m.parameters())
+            for name, layer in layers.items():
+                setattr(m, name, layer.to(device=p.device, dtype=p.dtype))
+        self._fused_modules = []
+
+    def quantize_effu_c1(self, calib_inputs, backend='x86'):
+        """Quantize the EFFU 1x1 convs to int8 with FX graph mode
+        quantization.
+
+        Activations use per-tensor symmetric and weights per-channel
+        symmetric int8. The 3x3 convs, CBAM and decoder are left untouched
+        and keep running in floating point. This is for CPU inference only:
+        the model must be on CPU, it is switched to eval mode and the
+        quantized modules can neither be trained nor loaded from a float
+        checkpoint. Requires PyTorch >= 1.13.
+
+        Note that the process-wide ``torch.backends.quantized.engine`` is
+        set to ``backend``. It is left that way on purpose, as the quantized
+        convs need the same engine at inference.
+
+        Args:
+            calib_inputs (Iterable[Tensor]): Input images used to calibrate
+                the activation ranges of the 1x1 convs.
+            backend (str): Quantized engine, e.g. 'x86', 'fbgemm' or
+                'qnnpack'. Default: 'x86'.
+
+        Returns:
+            AMDNet_EFFU: The model itself.
+        """
+        # Imported here so that loading this module does not require the
+        # torch.ao APIs of recent PyTorch versions.
+        from torch.ao.quantization import QConfig, QConfigMapping
+        from torch.ao.quantization.observer import (
+            HistogramObserver, default_per_channel_weight_observer)
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+        from torch.fx import GraphModule
+
+        assert all(p.device.type == 'cpu' for p in self.parameters()), \
+            'quantize_effu_c1 only supports models on CPU.'
+        # Prepared and converted modules are FX GraphModules, which can not
+        # be rebuilt a second time.
+        for stage in self.enc_stages:
+            c1 = stage.c1.convs if stage.split_fuse else [stage.c1]
+            assert not any(isinstance(m, GraphModule) for m in c1), \
+                'The EFFU 1x1 convs are already quantized.'
+        torch.backends.quantized.engine = backend
+        qconfig_mapping = QConfigMapping().set_global(
+            QConfig(
+                activation=HistogramObserver.with_args(
+                    dtype=torch.quint8,
+                    qscheme=torch.per_tensor_symmetric,
+                    reduce_range=True),
+                weight=default_per_channel_weight_observer))
+
+        def _prepare(module, in_channels):
+            example_inputs = (torch.randn(1, in_channels, 1, 1), )
+            return prepare_fx(module.eval(), qconfig_mapping, example_inputs)
+
+        # The 1x1 convs are rebuilt from plain torch.nn layers, as FX can not
+        # trace mmcv's conv wrapper and only matches torch.nn types.
+        self.eval()
+        for stage in self.enc_stages:
+            if stage.split_fuse:
+                for k, conv in enumerate(stage.c1.convs):
+                    stage.c1.convs[k] = _prepare(
+                        _to_torch_conv(conv), conv.in_channels)
+                continue
+            m = stage.c1[0]
+            layers = [_to_torch_conv(m.conv)]
+            if m.with_norm:
+                layers.append(m.norm)
+            if m.with_activation:
+                layers.append(m.activate)
+            stage.c1 = _prepare(nn.Sequential(*layers), m.conv.in_channels)
+
+        with torch.no_grad():
+            for img in calib_inputs:
+                self(img)
+
+        for stage in self.enc_stages:
+            if stage.split_fuse:
+                for k, conv in enumerate(stage.c1.convs):
+                    stage.c1.convs[k] = convert_fx(conv)
+            else:
+                stage.c1 = convert_fx(stage.c1)
+        return self
+
     def _check_input_divisible(self, x):
         h, w = x.shape[-2:]
-        whole_downsample_rate = 1
-        for i in range(1, self.num_stages):
-            if self.strides[i] == 2 or self.downsamples[i - 1]:
-                whole_downsample_rate *= 2
-        assert (h % whole_downsample_rate == 0) \
-            and (w % whole_downsample_rate == 0),\
+        assert (h % self._wdr == 0) and (w % self._wdr == 0),\
             f'The input image size {(h, w)} should be divisible by the whole '\
-            f'downsample rate {whole_downsample_rate}, when num_stages is '\
+            f'downsample rate {self._wdr}, when num_stages is '\
             f'{self.num_stages}, strides is {self.strides}, and downsamples '\
             f'is {self.downsamples}.'